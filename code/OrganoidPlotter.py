@@ -12,10 +12,12 @@ plt.rcParams['axes.titlesize'] = 24  # Larger title size
 plt.rcParams['axes.labelsize'] = 20  # Axis label size
 plt.rcParams['xtick.labelsize'] = 18  # X-axis tick label size
 plt.rcParams['ytick.labelsize'] = 18  # Y-axis tick label size
+# Tick labels (including the colorbar) pick up the family and sizes above; no per-label overrides needed
 
-# Savitzky–Golay filter for smoothing
+# Savitzky–Golay filter and running mean for smoothing
 try:
     from scipy.signal import savgol_filter  # noqa: F401
+    from scipy.ndimage import uniform_filter1d  # noqa: F401
 except ImportError as e:
     raise ImportError(
         "SciPy is required for Savitzky–Golay filtering. Install it via 'pip install scipy' or 'conda install scipy'."
@@ -50,60 +52,72 @@ z_thresh = 3           # Z‑score threshold for outlier detection
 window_length = 10    # Savitzky–Golay window (must be odd)
 poly_order = 7         # Polynomial order for Savitzky–Golay
 
-# Create a cleaned/smoothed DataFrame
-clean_df = df.copy()
-
-for metric in metrics + ["centroid_x", "centroid_y"]:
-    series = clean_df[metric]
-
-    # Remove centroid outlier below (650, 650)
-    if metric in ["centroid_x", "centroid_y"]:
-        mask = ~((clean_df["centroid_x"] < 650) & (clean_df["centroid_y"] < 650))
-        series = series[mask]
+def smooth_matrix(M):
+    """Z-score filter, interpolate, SavGol and rolling-average every column of M at once."""
+    M = np.array(M, dtype=np.float64, copy=True)
 
     # ----- Outlier removal (Z‑score) -----
-    z_scores = (series - series.mean()) / series.std(ddof=0)
-    series_filtered = series.mask(z_scores.abs() > z_thresh)
+    # |x - mean| > z * std, with the deviations reused for the (ddof=0) std and no division
+    dev = M - M.mean(axis=0, keepdims=True)
+    sd = np.sqrt(np.mean(dev * dev, axis=0, keepdims=True))
+    M[np.abs(dev) > z_thresh * sd] = np.nan
 
     # Interpolate removed outliers and fill edges
-    series_filtered = series_filtered.interpolate()
-    series_filtered = series_filtered.bfill().ffill()
+    M = pd.DataFrame(M).interpolate().bfill().ffill().to_numpy()
 
     # ----- Savitzky–Golay smoothing -----
-    n_points = len(series_filtered)
+    n_points = len(M)
     win = min(window_length, n_points if n_points % 2 == 1 else n_points - 1)
     if win < 5:
         win = 5 if n_points >= 5 else (n_points | 1)
 
-    sg_series = savgol_filter(series_filtered, window_length=win, polyorder=min(poly_order, win - 1))
+    M = savgol_filter(M, window_length=win, polyorder=min(poly_order, win - 1), axis=0)
 
-    # Optional rolling‑average smoothing on top of SavGol
+    # Optional rolling‑average smoothing on top of SavGol (centered, min_periods=1): zero-padded
+    # window sums divided by the number of real samples in each window, so edges shrink the window
     if APPLY_ROLLING and ROLLING_WINDOW >= 2:
-        sg_series = pd.Series(sg_series, index=series_filtered.index)
-        ra_series = sg_series.rolling(window=ROLLING_WINDOW, center=True, min_periods=1).mean()
-        smoothed = ra_series.values
-    else:
-        smoothed = sg_series
+        counts = uniform_filter1d(np.ones((n_points, 1)), size=ROLLING_WINDOW, axis=0, mode='constant')
+        M = uniform_filter1d(M, size=ROLLING_WINDOW, axis=0, mode='constant') / counts
+
+    return M
+
 
-    # Store back in DataFrame, aligning to original index
-    smoothed_series = pd.Series(smoothed, index=series_filtered.index)
-    clean_df[f"{metric}_smooth"] = smoothed_series.reindex(clean_df.index)
+# Metrics use every row; centroids drop the outlier below (650, 650) before smoothing
+centroid_cols = ["centroid_x", "centroid_y"]
+centroid_mask = ~((df["centroid_x"] < 650) & (df["centroid_y"] < 650)).to_numpy()
+
+smooth_cols = [f"{c}_smooth" for c in metrics + centroid_cols]
+smoothed_mat = np.full((len(df), len(smooth_cols)), np.nan)
+smoothed_mat[:, :len(metrics)] = smooth_matrix(df[metrics].to_numpy())
+smoothed_mat[centroid_mask, len(metrics):] = smooth_matrix(df[centroid_cols].to_numpy()[centroid_mask])
 
 # ------------------ Conversion ------------------
 # Conversion factor: 1 pixel = 0.00180 mm = 1.8 um
 PIXEL_TO_UM = 1.8
 
 # Convert centroid and metric values to micrometers and square millimeters for plotting
-clean_df['centroid_x_um'] = clean_df['centroid_x'] * PIXEL_TO_UM
-clean_df['centroid_y_um'] = clean_df['centroid_y'] * PIXEL_TO_UM
-clean_df['centroid_x_mm'] = clean_df['centroid_x'] * 0.0018
-clean_df['centroid_y_mm'] = clean_df['centroid_y'] * 0.0018
-clean_df['area_um'] = clean_df['area'] * (PIXEL_TO_UM ** 2)
-clean_df['area_smooth_um'] = clean_df['area_smooth'] * (PIXEL_TO_UM ** 2)
-clean_df['area_mm2'] = clean_df['area'] * (0.0018 ** 2)
-clean_df['area_smooth_mm2'] = clean_df['area_smooth'] * (0.0018 ** 2)
+# (new column, source column, scale) — all columns are converted in one broadcast multiply
+conversions = [
+    ('centroid_x_um', 'centroid_x', PIXEL_TO_UM),
+    ('centroid_y_um', 'centroid_y', PIXEL_TO_UM),
+    ('centroid_x_mm', 'centroid_x', 0.0018),
+    ('centroid_y_mm', 'centroid_y', 0.0018),
+    ('area_um', 'area', PIXEL_TO_UM ** 2),
+    ('area_smooth_um', 'area_smooth', PIXEL_TO_UM ** 2),
+    ('area_mm2', 'area', 0.0018 ** 2),
+    ('area_smooth_mm2', 'area_smooth', 0.0018 ** 2),
+]
+new_cols, src_cols, scales = zip(*conversions)
+smoothed = dict(zip(smooth_cols, smoothed_mat.T))
+src_mat = np.column_stack([smoothed[c] if c in smoothed else df[c].to_numpy(dtype=np.float64) for c in src_cols])
+converted_mat = src_mat * np.array(scales)
 # If solidity is unitless, do not convert
 
+# Create the cleaned/smoothed DataFrame with all derived columns in a single concat
+new_df = pd.DataFrame(np.hstack([smoothed_mat, converted_mat]), index=df.index,
+                      columns=smooth_cols + list(new_cols))
+clean_df = pd.concat([df, new_df], axis=1)
+
 # ------------------ Plotting --------------------
 fig, axes = plt.subplots(1, 3, figsize=(18, 5), gridspec_kw={'width_ratios': [1, 1, 1.2]})
 
@@ -136,14 +150,6 @@ for i, (ax, metric) in enumerate(zip(axes[:2], metrics)):
     ax.tick_params(axis='x', which='minor', length=6, width=1, direction='out')
     ax.tick_params(axis='x', which='minor', labelbottom=False)  # No labels for minor ticks
     ax.set_xlabel("Day", fontfamily='Arial', fontsize=20)
-    
-    # Set Arial font for tick labels
-    for label in ax.get_xticklabels():
-        label.set_fontfamily('Arial')
-        label.set_fontsize(18)
-    for label in ax.get_yticklabels():
-        label.set_fontfamily('Arial')
-        label.set_fontsize(18)
 
 # Plot centroid_x vs centroid_y as a connected line plot with a color gradient that darkens over time
 ax = axes[2]
@@ -153,13 +159,17 @@ num_points = len(centroid_x_sampled)
 from matplotlib.collections import LineCollection
 from matplotlib.colors import Normalize
 from matplotlib.colorbar import ColorbarBase
-points = np.array([centroid_x_sampled, centroid_y_sampled]).T.reshape(-1, 1, 2)
-segments = np.concatenate([points[:-1], points[1:]], axis=1)
-# Use a rainbow colormap for the gradient
-lc = LineCollection(segments, cmap='rainbow', norm=plt.Normalize(0, num_points-1))
-lc.set_array(np.arange(num_points-1))
-lc.set_linewidth(2)
-lc.set_alpha(0.4)
+# Consecutive point pairs as an (N-1, 2, 2) strided view of the (N, 2) coordinates, no copy;
+# fewer than two samples (a CSV of 11 rows or less) leave the trajectory empty
+if num_points >= 2:
+    coords = np.stack([centroid_x_sampled, centroid_y_sampled], axis=1)
+    segments = np.lib.stride_tricks.sliding_window_view(coords, window_shape=(2, 2))[:, 0]
+    # Use a rainbow colormap for the gradient, resolved to RGBA once instead of at every draw
+    segment_colors = matplotlib.colormaps['rainbow'](np.arange(num_points - 1) / (num_points - 1))
+else:
+    segments = np.empty((0, 2, 2))
+    segment_colors = np.empty((0, 4))
+lc = LineCollection(segments, colors=segment_colors, linewidth=2, alpha=0.4)
 ax.add_collection(lc)
 # Set axis ranges for centroid plot in millimeters
 ax.set_xlim(870 * 0.0018, 940 * 0.0018)
@@ -170,23 +180,12 @@ ax.set_ylabel("Y Centroid (mm)", fontfamily='Arial', fontsize=20)
 # Remove grid
 ax.grid(False)
 
-# Set Arial font for centroid plot tick labels
-for label in ax.get_xticklabels():
-    label.set_fontfamily('Arial')
-    label.set_fontsize(18)
-for label in ax.get_yticklabels():
-    label.set_fontfamily('Arial')
-    label.set_fontsize(18)
-
 # Add a colorbar legend for the rainbow gradient indicating Day 0 and Day 14
 cbar_ax = fig.add_axes([0.92, 0.18, 0.015, 0.65])  # [left, bottom, width, height]
 norm = Normalize(vmin=0, vmax=total_days)
 cbar = ColorbarBase(cbar_ax, cmap='rainbow', norm=norm, orientation='vertical')
 cbar.set_ticks([0, total_days])
 cbar.set_ticklabels(['Day 0', f'Day {total_days}'])
-# Set Arial font for colorbar tick labels
-for label in cbar.ax.get_yticklabels():
-    label.set_fontfamily('Arial')
 
 plt.tight_layout(rect=[0, 0, 0.91, 1])
 
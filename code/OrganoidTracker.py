@@ -1,15 +1,31 @@
 import cv2
 import numpy as np
+import pandas as pd
 from tqdm import tqdm
 from datetime import datetime, timedelta
-import csv
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+import multiprocessing as mp
+import queue
+import threading
+import math
 import os
 
+# Numba JIT for the per-frame contour statistics
+try:
+    from numba import njit
+except ImportError as e:
+    raise ImportError(
+        "Numba is required for contour statistics. Install it via 'pip install numba' or 'conda install numba'."
+    ) from e
+
 """
 Single‑organoid tracker for bright (white/grey) objects on a dark background
 --------------------------------------------------------------------------
 * Enhanced contrast and relaxed edge detection to better capture faint boundaries.
-* Saves one metrics CSV, one optional contours CSV, and a visual overlay video.
+* Saves one metrics CSV, one optional contours NPZ, and a visual overlay video.
+* The overlay is rendered in a second pass from the saved contours, so tracking never draws.
 """
 
 # -------------------- USER CONFIG --------------------
@@ -17,133 +33,400 @@ video_path = "/Coding/DrewOrganoidTrackingandGraphing/input/santhosh4x_longorgan
 output_folder = "/Coding/DrewOrganoidTrackingandGraphing/output"
 frame_skip = 1               # analyse every N‑th frame
 min_area = 2000                   # further reduced to capture smaller/fragmented shapes
+hw_decode = True             # ask FFmpeg for NVDEC/VAAPI/etc. decode, falls back to CPU
+use_opencl = False           # run CLAHE/blur/threshold/morphology on an OpenCL device if one exists;
+                             # every worker would open its own context, so it needs n_workers = 1
+n_workers = os.cpu_count() or 1   # processes running process_frame in parallel
+write_overlay = True         # False skips the overlay video pass entirely (metrics only)
+overlay_every = 1            # render every K‑th analysed frame into the overlay video
+# Metrics written to the CSV; OrganoidPlotter reads these four. Add any of perimeter,
+# aspect_ratio, shape_factor, extent, eccentricity to compute and save them too.
+metrics_to_compute = {"area", "solidity", "centroid_x", "centroid_y"}
 
 total_duration = timedelta(days=14)
 start_time = datetime(2025, 5, 5, 16, 0, 0)
 # -----------------------------------------------------
 
-contour_data = []   # frame‑wise quantitative metrics
-all_contours = []   # optional raw contour points for debugging
+all_contours = []   # optional raw contour points for debugging, one per MetricBuffers row
+_worker = {}        # per-process CLAHE / Gaussian kernel / scratch buffers, see init_worker
+morph_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))  # small kernel, one pass each
+
+
+# Every metric the tracker knows, in CSV column order
+METRIC_DTYPES = {
+    "area": np.float64,
+    "perimeter": np.float64,
+    "centroid_x": np.int32,
+    "centroid_y": np.int32,
+    "aspect_ratio": np.float64,
+    "shape_factor": np.float64,
+    "solidity": np.float64,
+    "extent": np.float64,
+    "eccentricity": np.float64,
+}
+# The configured subset, in the order process_frame returns them and the CSV lists them
+active_metrics = tuple(name for name in METRIC_DTYPES if name in metrics_to_compute)
+OVERLAY_METRICS = {"area", "centroid_x", "centroid_y", "solidity"}  # read by render_overlay
+
+
+@dataclass
+class MetricBuffers:
+    """Frame‑wise quantitative metrics as structure‑of‑arrays; row k is the k‑th detection.
+
+    *columns* holds one array per name in active_metrics, typed from METRIC_DTYPES.
+    """
+    frame_idx: np.ndarray
+    columns: dict
+    n: int = 0
+
+    @classmethod
+    def allocate(cls, capacity):
+        capacity = max(capacity, 1)
+        columns = {name: np.empty(capacity, METRIC_DTYPES[name]) for name in active_metrics}
+        return cls(frame_idx=np.empty(capacity, np.int64), columns=columns)
+
+    def append(self, frame_idx, values):
+        """Store one detection; *values* follow active_metrics order."""
+        if self.n == len(self.frame_idx):
+            # CAP_PROP_FRAME_COUNT under-reported the video length; double the capacity
+            self.frame_idx = np.concatenate([self.frame_idx, np.empty_like(self.frame_idx)])
+            for name, arr in self.columns.items():
+                self.columns[name] = np.concatenate([arr, np.empty_like(arr)])
+        k = self.n
+        self.frame_idx[k] = frame_idx
+        for name, value in zip(active_metrics, values):
+            self.columns[name][k] = value
+        self.n = k + 1
+
+    def column(self, name):
+        arr = self.frame_idx if name == "frame_idx" else self.columns[name]
+        return arr[:self.n]
+
+
+@njit(cache=True, fastmath=True)
+def contour_stats(pts):
+    """Area, perimeter, centroid and bounding box of a closed (N, 2) contour in one pass.
+
+    Matches cv2.contourArea / arcLength(closed=True) / moments / boundingRect.
+    """
+    n = pts.shape[0]
+    a2 = 0.0      # twice the signed area (shoelace)
+    mx = 0.0      # 6 * signed m10
+    my = 0.0      # 6 * signed m01
+    perim = 0.0
+    x_min = x_max = pts[0, 0]
+    y_min = y_max = pts[0, 1]
+    for i in range(n):
+        x = pts[i, 0]
+        y = pts[i, 1]
+        j = i + 1 if i + 1 < n else 0
+        xn = pts[j, 0]
+        yn = pts[j, 1]
+        cross = float(x) * yn - float(xn) * y
+        a2 += cross
+        mx += (x + xn) * cross
+        my += (y + yn) * cross
+        perim += math.hypot(xn - x, yn - y)
+        x_min = min(x_min, x)
+        x_max = max(x_max, x)
+        y_min = min(y_min, y)
+        y_max = max(y_max, y)
+
+    area = abs(a2) * 0.5
+    cx = cy = 0.0
+    if a2 != 0.0:
+        cx = mx / (3.0 * a2)
+        cy = my / (3.0 * a2)
+    return area, perim, cx, cy, x_min, y_min, x_max - x_min + 1, y_max - y_min + 1
+
+
+@njit(cache=True, fastmath=True)
+def polygon_area(pts):
+    """Shoelace area of a closed (N, 2) polygon, e.g. a convex hull (= cv2.contourArea)."""
+    n = pts.shape[0]
+    a2 = 0.0
+    for i in range(n):
+        j = i + 1 if i + 1 < n else 0
+        a2 += float(pts[i, 0]) * pts[j, 1] - float(pts[j, 0]) * pts[i, 1]
+    return abs(a2) * 0.5
+
+
+def open_video(path):
+    """Open *path* with hardware-accelerated FFmpeg decode if available, else plain CPU decode."""
+    if hw_decode:
+        # No CAP_PROP_HW_DEVICE: FFmpeg refuses a device index together with ACCELERATION_ANY
+        cap = cv2.VideoCapture(path, cv2.CAP_FFMPEG, [
+            cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY,
+        ])
+        if cap.isOpened():
+            return cap
+        cap.release()
+    return cv2.VideoCapture(path)
+
+
+def init_worker():
+    """Pool initializer: single-threaded OpenCV plus this process's own CLAHE, kernel and buffers."""
+    cv2.setNumThreads(1)  # parallelism comes from the process pool, don't oversubscribe
+    cv2.ocl.setUseOpenCL(use_opencl)  # stays off when no OpenCL device is available
+    _worker["clahe"] = cv2.createCLAHE(clipLimit=3.5, tileGridSize=(6, 6))  # stronger CLAHE
+    _worker["gk"] = cv2.getGaussianKernel(9, 2.0)                           # broader blur, 9x9 sigma 2
+    _worker["bufs"] = {}
+    # Compile (or load from cache) the contour kernels before the first frame arrives
+    contour_stats(np.zeros((3, 2), dtype=np.int32))
+    polygon_area(np.zeros((3, 2), dtype=np.int32))
+
+
+def track_frame(frame):
+    """Worker entry point: run process_frame with this process's state."""
+    return process_frame(frame, _worker["clahe"], _worker["gk"], _worker["bufs"])
+
+
+def frame_timestamps(frame_indices, frame_period):
+    """Timestamps of the given frame indices, computed in one datetime64[us] pass."""
+    return np.datetime64(start_time, "us") + frame_indices * np.timedelta64(frame_period)
+
+
+def read_frames(cap, frames, errors):
+    """Producer thread: decode every frame_skip‑th frame onto *frames*, then a None sentinel.
+
+    The sentinel is always sent; a decode exception is appended to *errors* for main to re-raise.
+    """
+    try:
+        frame_idx = 0
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+
+            frames.put((frame_idx, frame))
+            for _ in range(frame_skip - 1):  # skipped frames are grabbed, never decoded
+                cap.grab()
+            frame_idx += frame_skip
+    except Exception as e:
+        errors.append(e)
+    finally:
+        frames.put(None)
 
 
-def process_frame(frame, timestamp):
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+def scratch(bufs, name, shape):
+    """uint8 buffer *name* from *bufs*, reallocated only when the requested shape changes."""
+    buf = bufs.get(name)
+    if buf is None or buf.shape != shape:
+        buf = bufs[name] = np.empty(shape, dtype=np.uint8)
+    return buf
 
-    # Contrast enhancement
-    clahe = cv2.createCLAHE(clipLimit=3.5, tileGridSize=(6, 6))  # stronger CLAHE
-    enhanced = clahe.apply(gray)
 
-    # Slight smoothing to boost faint gradients
-    blurred = cv2.GaussianBlur(enhanced, (9, 9), sigmaX=2.0)  # broader blur
+def organoid_mask(frame, clahe, gk, bufs):
+    """Binary foreground mask of *frame*, computed on the host into the scratch buffers in *bufs*."""
+    shape = frame.shape[:2]
+    gray, enhanced, blurred, mask, tmp = (scratch(bufs, name, shape)
+                                          for name in ("gray", "enhanced", "blurred", "mask", "tmp"))
+
+    cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=gray)
+
+    # Contrast enhancement (CLAHE object is built once per worker)
+    clahe.apply(gray, dst=enhanced)
+
+    # Slight smoothing to boost faint gradients (separable Gaussian, kernel cached per worker)
+    cv2.sepFilter2D(enhanced, -1, gk, gk, dst=blurred)
 
     # Otsu threshold
+    cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=mask)
+
+    # Morphology: open (erode → dilate) then close (dilate → erode), ping‑ponging mask/tmp
+    cv2.erode(mask, morph_kernel, dst=tmp)
+    cv2.dilate(tmp, morph_kernel, dst=mask)
+    cv2.dilate(mask, morph_kernel, dst=tmp)
+    cv2.erode(tmp, morph_kernel, dst=mask)
+    return mask
+
+
+def organoid_mask_ocl(frame, clahe, gk):
+    """Same pipeline as organoid_mask on cv2.UMat (OpenCL T‑API); only the final mask is downloaded."""
+    gray = cv2.cvtColor(cv2.UMat(frame), cv2.COLOR_BGR2GRAY)
+    enhanced = clahe.apply(gray)
+    blurred = cv2.sepFilter2D(enhanced, -1, gk, gk)
     _, mask = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    mask = cv2.dilate(cv2.erode(mask, morph_kernel), morph_kernel)  # open
+    mask = cv2.erode(cv2.dilate(mask, morph_kernel), morph_kernel)  # close
+    return mask.get()
+
 
-    # Morphology with smaller kernel, fewer iterations
-    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
-    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel, iterations=1)
-    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel, iterations=1)
+def find_organoid(frame, clahe, gk, bufs=None):
+    """Largest bright contour in *frame*, or None.
+
+    Intermediate images go to an OpenCL device when enabled, otherwise into the scratch
+    buffers in *bufs*.
+    """
+    if cv2.ocl.useOpenCL():
+        mask = organoid_mask_ocl(frame, clahe, gk)
+    else:
+        mask = organoid_mask(frame, clahe, gk, {} if bufs is None else bufs)
 
     contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     if not contours:
-        return frame
-
-    cnt = max(contours, key=cv2.contourArea)
-    if cv2.contourArea(cnt) < min_area:
-        return frame
-
-    all_contours.append((cnt, timestamp))
-
-    area = cv2.contourArea(cnt)
-    perimeter = cv2.arcLength(cnt, True)
-    M = cv2.moments(cnt)
-    cx = int(M["m10"] / M["m00"]) if M["m00"] else 0
-    cy = int(M["m01"] / M["m00"]) if M["m00"] else 0
-    x, y, w, h = cv2.boundingRect(cnt)
-    aspect_ratio = w / h
-    shape_factor = (4 * np.pi * area) / (perimeter ** 2) if perimeter else 0
-    hull = cv2.convexHull(cnt)
-    hull_area = cv2.contourArea(hull)
-    solidity = area / hull_area if hull_area else 0
-    extent = area / (w * h) if w * h else 0
-    eccentricity = np.sqrt(1 - (min(w, h) / max(w, h)) ** 2) if max(w, h) else 0
-
-    contour_data.append({
-        "timestamp": timestamp,
-        "area": area,
-        "perimeter": perimeter,
-        "centroid_x": cx,
-        "centroid_y": cy,
-        "aspect_ratio": aspect_ratio,
-        "shape_factor": shape_factor,
-        "solidity": solidity,
-        "extent": extent,
-        "eccentricity": eccentricity,
-    })
-
-    # Overlay
+        return None
+    return max(contours, key=cv2.contourArea)
+
+
+def process_frame(frame, clahe, gk, bufs=None):
+    """Segment the organoid and measure it.
+
+    Returns (contour, metrics) with metrics a tuple in active_metrics order,
+    or (None, None) when nothing is found.
+    """
+    cnt = find_organoid(frame, clahe, gk, bufs)
+    if cnt is None:
+        return None, None
+    area, perimeter, cx, cy, x, y, w, h = contour_stats(cnt.reshape(-1, 2))
+    if area < min_area:
+        return None, None
+
+    # Only the metrics someone reads are derived; area/perimeter/centroid come free with stats
+    values = {"area": area, "perimeter": perimeter, "centroid_x": int(cx), "centroid_y": int(cy)}
+    if "aspect_ratio" in metrics_to_compute:
+        values["aspect_ratio"] = w / h
+    if "shape_factor" in metrics_to_compute:
+        values["shape_factor"] = (4 * np.pi * area) / (perimeter ** 2) if perimeter else 0
+    if "solidity" in metrics_to_compute:
+        hull = cv2.convexHull(cnt)
+        hull_area = polygon_area(hull.reshape(-1, 2))
+        values["solidity"] = area / hull_area if hull_area else 0
+    if "extent" in metrics_to_compute:
+        values["extent"] = area / (w * h) if w * h else 0
+    if "eccentricity" in metrics_to_compute:
+        values["eccentricity"] = np.sqrt(1 - (min(w, h) / max(w, h)) ** 2) if max(w, h) else 0
+
+    metrics = tuple(values[name] for name in active_metrics)
+    return cnt, metrics
+
+
+def draw_overlay(frame, cnt, cx, cy, area, solidity):
+    """Draw the tracked contour, centroid and label onto *frame* in place."""
+    x, y, _, _ = cv2.boundingRect(cnt)
     cv2.drawContours(frame, [cnt], -1, (0, 255, 0), 2)
-    cv2.circle(frame, (cx, cy), 4, (0, 0, 255), -1)
+    cv2.circle(frame, (int(cx), int(cy)), 4, (0, 0, 255), -1)
     label = f"Area: {int(area)} | Solidity: {solidity:.2f}"
     cv2.putText(frame, label, (x, y - 100), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
-    return frame
 
 
-def main():
-    os.makedirs(output_folder, exist_ok=True)
+def render_overlay(overlay_path, fps, width, height, metrics):
+    """Second pass: re‑decode the video and draw the cached contours onto every
+    overlay_every‑th analysed frame."""
+    tracked = {
+        frame_idx: (cnt, cx, cy, area, solidity)
+        for frame_idx, cnt, cx, cy, area, solidity in zip(
+            metrics.column("frame_idx"), all_contours, metrics.column("centroid_x"),
+            metrics.column("centroid_y"), metrics.column("area"), metrics.column("solidity"))
+    }
+    step = frame_skip * overlay_every
 
-    cap = cv2.VideoCapture(video_path)
-    fps = cap.get(cv2.CAP_PROP_FPS) or 30
-    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) or 1
-
-    frame_period = total_duration / total_frames if total_duration else timedelta(seconds=1 / fps)
-    overlay_path = os.path.join(output_folder, "tracked_overlay.avi")
+    cap = open_video(video_path)
     fourcc = cv2.VideoWriter_fourcc(*"XVID")
-    out = cv2.VideoWriter(overlay_path, fourcc, fps // frame_skip, (width, height))
-
+    out = cv2.VideoWriter(overlay_path, fourcc, max(fps // step, 1), (width, height))
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) or 1
     frame_idx = 0
-    with tqdm(total=total_frames // frame_skip, desc="Processing", unit="frame") as bar:
-        while cap.isOpened():
-            if frame_idx % frame_skip != 0:
-                frame_idx += 1
-                cap.grab()
-                continue
-
+    with tqdm(total=total_frames // step, desc="Rendering", unit="frame") as bar:
+        while True:
             ret, frame = cap.read()
             if not ret:
                 break
 
-            ts = start_time + frame_idx * frame_period
-            result_frame = process_frame(frame, ts)
-            out.write(result_frame)
-
-            frame_idx += 1
+            if frame_idx in tracked:
+                draw_overlay(frame, *tracked[frame_idx])
+            out.write(frame)
+            for _ in range(step - 1):
+                cap.grab()
+            frame_idx += step
             bar.update(1)
 
     cap.release()
     out.release()
 
+
+def main():
+    if write_overlay and not OVERLAY_METRICS <= metrics_to_compute:
+        raise ValueError(f"write_overlay needs metrics_to_compute to include {sorted(OVERLAY_METRICS)}")
+    if use_opencl and n_workers > 1:
+        raise ValueError("use_opencl needs n_workers = 1 (one OpenCL context per worker oversubscribes the device)")
+    os.makedirs(output_folder, exist_ok=True)
+
+    # Probe the metadata with a short-lived capture: the decoding one (FFmpeg threads, any
+    # hardware context) is only opened once the fork-based pool is running
+    probe = cv2.VideoCapture(video_path)
+    fps = probe.get(cv2.CAP_PROP_FPS) or 30
+    width = int(probe.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(probe.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    total_frames = int(probe.get(cv2.CAP_PROP_FRAME_COUNT)) or 1
+    probe.release()
+
+    frame_period = total_duration / total_frames if total_duration else timedelta(seconds=1 / fps)
+    metrics = MetricBuffers.allocate(-(-total_frames // frame_skip))
+
+    def collect(frame_idx, result):
+        cnt, values = result
+        if values is not None:
+            all_contours.append(cnt)
+            metrics.append(frame_idx, values)
+
+    # fork skips re-importing this script in every worker; other platforms use their default
+    ctx = mp.get_context("fork") if "fork" in mp.get_all_start_methods() else None
+    window = 2 * n_workers
+    frames = queue.Queue(maxsize=window)
+    read_errors = []
+    with ProcessPoolExecutor(n_workers, mp_context=ctx, initializer=init_worker) as pool:
+        # Start the workers before the capture and decode thread exist so fork never copies them
+        pool.submit(int).result()
+        cap = open_video(video_path)
+        producer = threading.Thread(target=read_frames, args=(cap, frames, read_errors), daemon=True)
+        producer.start()
+
+        # Futures are consumed in submission order, so results stay in frame order
+        pending = deque()
+        with tqdm(total=total_frames // frame_skip, desc="Processing", unit="frame") as bar:
+            while True:
+                item = frames.get()
+                if item is None:
+                    break
+                frame_idx, frame = item
+                pending.append((frame_idx, pool.submit(track_frame, frame)))
+                if len(pending) >= window:
+                    frame_idx, future = pending.popleft()
+                    collect(frame_idx, future.result())
+                    bar.update(1)
+            while pending:
+                frame_idx, future = pending.popleft()
+                collect(frame_idx, future.result())
+                bar.update(1)
+        producer.join()
+
+    cap.release()
+    if read_errors:
+        raise read_errors[0]
+
+    frame_indices = metrics.column("frame_idx")
+    timestamps = frame_timestamps(frame_indices, frame_period)
+
     metrics_file = os.path.join(output_folder, "white_organoid_metrics.csv")
-    if contour_data:
-        with open(metrics_file, "w", newline="") as f:
-            writer = csv.DictWriter(f, fieldnames=contour_data[0].keys())
-            writer.writeheader()
-            writer.writerows(contour_data)
+    if metrics.n:
+        table = {"timestamp": timestamps, **{name: metrics.column(name) for name in active_metrics}}
+        pd.DataFrame(table).to_csv(metrics_file, index=False)
         print(f"Saved contour metrics → {metrics_file}")
 
-    contours_file = os.path.join(output_folder, "white_organoid_all_contours.csv")
+    # Ragged layout: contour i is points[offsets[i]:offsets[i + 1]] (x, y pixel pairs)
+    contours_file = os.path.join(output_folder, "white_organoid_all_contours.npz")
     if all_contours:
-        with open(contours_file, "w", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerow(["timestamp", "contour_points"])
-            for cnt, ts in all_contours:
-                pts = [[p[0][0], p[0][1]] for p in cnt]
-                writer.writerow([ts, pts])
+        offsets = np.zeros(len(all_contours) + 1, dtype=np.int64)
+        np.cumsum([len(cnt) for cnt in all_contours], out=offsets[1:])
+        points = np.concatenate([cnt.reshape(-1, 2) for cnt in all_contours]).astype(np.int32)
+        np.savez_compressed(contours_file, points=points, offsets=offsets, timestamps=timestamps,
+                            frame_indices=frame_indices)
         print(f"Saved raw contours     → {contours_file}")
 
-    print(f"Overlay video saved    → {overlay_path}")
+    if write_overlay:
+        overlay_path = os.path.join(output_folder, "tracked_overlay.avi")
+        render_overlay(overlay_path, fps, width, height, metrics)
+        print(f"Overlay video saved    → {overlay_path}")
 
 
 if __name__ == "__main__":